@@ -7,9 +7,20 @@ Dynamically resolve IPs using enhanced DNS techniques.
 
 import sys
 import argparse
-import dns.resolver
-from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import datetime
+import dns.asyncquery
+import dns.exception
+import dns.flags
+import dns.message
+import dns.rcode
+import itertools
+import json
+import os
 import socket
+import tempfile
+import time
+from collections import OrderedDict
 
 # Expanded list of public DNS servers
 PUBLIC_DNS = [
@@ -22,72 +33,410 @@ PUBLIC_DNS = [
     "185.228.168.168", "185.228.169.168" # CleanBrowsing
 ]
 
-def resolve_with_dnspython(domain, dns_server):
-    """Resolve IPs using dnspython."""
-    resolver = dns.resolver.Resolver()
-    resolver.nameservers = [dns_server]
-    ips = set()
+# Upper bound on DNS queries in flight at once
+MAX_INFLIGHT = 500
+
+# Per-query timeout, in seconds
+DNS_LIFETIME = 2.0
+
+# Most DNS servers asked per domain, and how long (in multiples of the
+# best server's sRTT) to wait before hedging to the next one
+RACE_WIDTH = 3
+HEDGE_FACTOR = 1.5
+
+# Distinct DNS IPs after which --fast skips the system-resolver fallback
+ENOUGH_IPS = 3
+
+# Persistent DNS answer cache, keyed by "domain/rdtype"
+CACHE_FILE = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "web-blocker", "dns.json"
+)
+CACHE_MAX_ENTRIES = 400
+ERROR_TTL = 0.15  # seconds to remember empty (NOERROR) answers
+NX_TTL = 86400  # seconds to remember NXDOMAIN answers
+
+# Known-nonexistent names shipped alongside the script, with an explicit
+# "expires" date. Until then they seed the cache as NXDOMAIN answers;
+# afterwards they are queried like any other name.
+NX_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "nxdomain.json")
+
+def seed_nxdomains():
+    """Cache shipped NXDOMAIN names until the list's expiry date."""
     try:
-        answers = resolver.resolve(domain, "A")
-        for rdata in answers:
-            ips.add(rdata.address)
-    except Exception as e:
-        print(f"Debug: dnspython failed for {domain} with {dns_server}: {e}", file=sys.stderr)
+        with open(NX_FILE) as f:
+            shipped = json.load(f)
+        expires = datetime.datetime.fromisoformat(shipped["expires"])
+        ttl = expires.replace(tzinfo=datetime.timezone.utc).timestamp() - time.time()
+        if ttl <= 0:
+            return
+        for name in shipped["names"]:
+            if cache_get(name) is None:
+                cache_put(name, set(), ttl)
+    except (OSError, TypeError, ValueError, KeyError, AttributeError) as e:
+        print(f"Debug: Could not load {NX_FILE}: {e}", file=sys.stderr)
+
+def load_cache():
+    """Load unexpired cache entries from disk; a malformed file is ignored."""
+    cache = OrderedDict()
+    try:
+        with open(CACHE_FILE) as f:
+            entries = json.load(f)
+        now = time.time()
+        for key, (ips, expiry) in entries.items():
+            if expiry > now:
+                cache[key] = (frozenset(ips), expiry)
+    except OSError:
+        return OrderedDict()
+    except (TypeError, ValueError, AttributeError) as e:
+        print(f"Debug: Ignoring malformed DNS cache {CACHE_FILE}: {e}", file=sys.stderr)
+        return OrderedDict()
+    return cache
+
+def write_json(path, data):
+    """Atomically replace path with data serialized as JSON."""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def save_cache():
+    """Write the cache back to disk, dropping expired entries."""
+    now = time.time()
+    entries = {
+        key: [sorted(ips), expiry]
+        for key, (ips, expiry) in _DNS_CACHE.items()
+        if expiry > now
+    }
+    try:
+        write_json(CACHE_FILE, entries)
+    except OSError as e:
+        print(f"Debug: Could not save DNS cache to {CACHE_FILE}: {e}", file=sys.stderr)
+
+def cache_get(domain, rdtype="A"):
+    """Return cached IPs for domain, or None on a miss."""
+    key = f"{domain}/{rdtype}"
+    entry = _DNS_CACHE.get(key)
+    if entry is None:
+        return None
+    ips, expiry = entry
+    if expiry <= time.time():
+        del _DNS_CACHE[key]
+        return None
+    _DNS_CACHE.move_to_end(key)
     return ips
 
-def resolve_with_socket(domain):
-    """Resolve IPs using socket as a fallback."""
+def cache_put(domain, ips, ttl, rdtype="A"):
+    """Store an answer (empty for negative ones) for ttl seconds."""
+    key = f"{domain}/{rdtype}"
+    _DNS_CACHE[key] = (frozenset(ips), time.time() + ttl)
+    _DNS_CACHE.move_to_end(key)
+    while len(_DNS_CACHE) > CACHE_MAX_ENTRIES:
+        _DNS_CACHE.popitem(last=False)
+
+# Smoothed round-trip time per DNS server, in seconds (BIND-style sRTT)
+RTT_ALPHA = 0.125
+_RTT = {dns_server: 0.05 for dns_server in PUBLIC_DNS}
+
+# sRTT and penalties persist next to the answer cache, since each run
+# picks servers for every domain before any reply has been timed
+RTT_FILE = os.path.join(os.path.dirname(CACHE_FILE), "rtt.json")
+
+# Failure penalty added to a server's sRTT, halving every minute
+FAILURE_PENALTY = 2.0
+PENALTY_HALF_LIFE = 60.0
+_PENALTY = {}
+
+def update_rtt(dns_server, sample):
+    """Fold a new RTT sample into the server's moving average."""
+    _RTT[dns_server] = (1 - RTT_ALPHA) * _RTT[dns_server] + RTT_ALPHA * sample
+
+def current_penalty(dns_server):
+    """Return the server's failure penalty, decayed to now."""
+    penalty, since = _PENALTY.get(dns_server, (0.0, 0.0))
+    return penalty * 0.5 ** (max(time.time() - since, 0.0) / PENALTY_HALF_LIFE)
+
+def penalize(dns_server):
+    """Push a failing server down the ranking."""
+    _PENALTY[dns_server] = (current_penalty(dns_server) + FAILURE_PENALTY, time.time())
+
+def load_rtt():
+    """Restore sRTT and penalties from earlier runs; a malformed file is ignored."""
+    try:
+        with open(RTT_FILE) as f:
+            state = json.load(f)
+        rtt = {
+            dns_server: float(sample)
+            for dns_server, sample in state["rtt"].items()
+            if dns_server in _RTT
+        }
+        penalties = {
+            dns_server: (float(penalty), float(since))
+            for dns_server, (penalty, since) in state["penalty"].items()
+            if dns_server in _RTT
+        }
+    except OSError:
+        return
+    except (TypeError, ValueError, AttributeError, KeyError) as e:
+        print(f"Debug: Ignoring malformed RTT state {RTT_FILE}: {e}", file=sys.stderr)
+        return
+    _RTT.update(rtt)
+    _PENALTY.update(penalties)
+
+def save_rtt():
+    """Persist sRTT and penalties so the next run starts from a real ranking."""
+    state = {
+        "rtt": _RTT,
+        "penalty": {dns_server: list(entry) for dns_server, entry in _PENALTY.items()},
+    }
+    try:
+        write_json(RTT_FILE, state)
+    except OSError as e:
+        print(f"Debug: Could not save RTT state to {RTT_FILE}: {e}", file=sys.stderr)
+
+def ranked_servers():
+    """Return PUBLIC_DNS ordered by sRTT plus decayed failure penalty."""
+    return sorted(PUBLIC_DNS, key=lambda dns_server: _RTT[dns_server] + current_penalty(dns_server))
+
+# Wall-clock expiries so entries stay valid across runs
+_DNS_CACHE = load_cache()
+load_rtt()
+seed_nxdomains()
+
+# Hedged queries in flight, keyed by query name
+_INFLIGHT = {}
+
+class DNSClient(asyncio.DatagramProtocol):
+    """Pipeline DNS queries over one UDP socket, matched by transaction ID."""
+
+    def __init__(self):
+        self.transport = None
+        self.pending = {}
+        self.limit = asyncio.Semaphore(MAX_INFLIGHT)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            response = dns.message.from_wire(data)
+        except dns.exception.DNSException:
+            return
+        entry = self.pending.get((addr[0], response.id))
+        if entry is None:
+            return
+        request, future = entry
+        # Ignore stray datagrams that merely collide on (server, id)
+        if not future.done() and request.is_response(response):
+            future.set_result(response)
+
+    def error_received(self, exc):
+        # ICMP errors can't be tied to a query; let it time out instead
+        pass
+
+    async def query(self, domain, dns_server):
+        """Send an A query to dns_server and wait for the matching reply."""
+        request = dns.message.make_query(domain, "A")
+        while (dns_server, request.id) in self.pending:
+            request = dns.message.make_query(domain, "A")
+        key = (dns_server, request.id)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[key] = (request, future)
+        try:
+            self.transport.sendto(request.to_wire(), (dns_server, 53))
+            response = await asyncio.wait_for(future, DNS_LIFETIME)
+        finally:
+            del self.pending[key]
+        if response.flags & dns.flags.TC:
+            response = await dns.asyncquery.tcp(request, dns_server, timeout=DNS_LIFETIME)
+        return response
+
+async def resolve_with_dnspython(client, domain, dns_server):
+    """Query one DNS server and update its sRTT.
+
+    Returns (ips, ttl, canonical, canonical_ttl, cname_ttl): ttl covers the
+    whole chain, canonical_ttl the canonical name's own answer, and
+    cname_ttl the alias -> canonical mapping.
+    """
+    async with client.limit:
+        start = time.perf_counter()
+        try:
+            response = await client.query(domain, dns_server)
+        except Exception:
+            penalize(dns_server)
+            raise
+        elapsed = time.perf_counter() - start
+
+    # Only usable replies count as RTT samples; a fast REFUSED/SERVFAIL
+    # must not make the server look better
+    rcode = response.rcode()
+    if rcode not in (dns.rcode.NOERROR, dns.rcode.NXDOMAIN):
+        penalize(dns_server)
+        raise dns.exception.DNSException(f"{dns_server} answered {dns.rcode.to_text(rcode)}")
+    update_rtt(dns_server, elapsed)
+    chain = response.resolve_chaining()
+    canonical = chain.canonical_name.to_text(omit_final_dot=True)
+    if chain.answer is None:
+        print(f"Debug: dnspython found no A records for {domain} with {dns_server}: {dns.rcode.to_text(rcode)}", file=sys.stderr)
+        ttl = NX_TTL if rcode == dns.rcode.NXDOMAIN else ERROR_TTL
+        ips, canonical_ttl = set(), ttl
+    else:
+        ttl = chain.minimum_ttl
+        ips, canonical_ttl = {rdata.address for rdata in chain.answer}, chain.answer.ttl
+    cname_ttl = min((rrset.ttl for rrset in chain.cnames), default=ttl)
+    return ips, ttl, canonical, canonical_ttl, cname_ttl
+
+async def resolve_domain(client, domain):
+    """Resolve domain from the cache, or via a shared hedged query."""
+    cached = cache_get(domain)
+    if cached is not None:
+        return set(cached)
+    # The alias -> canonical mapping usually outlives the CDN's short A
+    # TTL; query the canonical name instead, so every alias of the same
+    # host shares one cached answer and one in-flight query
+    canonical = cache_get(domain, "CNAME")
+    name = next(iter(canonical)) if canonical else domain
+    if name != domain:
+        cached = cache_get(name)
+        if cached is not None:
+            return set(cached)
+
+    task = _INFLIGHT.get(name)
+    if task is None:
+        task = asyncio.create_task(resolve_hedged(client, name))
+        _INFLIGHT[name] = task
+        task.add_done_callback(lambda _: _INFLIGHT.pop(name, None))
+    return set(await asyncio.shield(task))
+
+async def resolve_hedged(client, domain):
+    """Resolve domain via hedged queries to the fastest-ranked DNS servers."""
+    # Hedge: ask the best server, and only bring in the next one if no
+    # reply arrives within HEDGE_FACTOR x its sRTT (or the query fails)
+    servers = iter(ranked_servers()[:RACE_WIDTH])
+    pending = {}
+    launched = []
+
+    def hedge():
+        dns_server = next(servers, None)
+        if dns_server is not None:
+            task = asyncio.create_task(resolve_with_dnspython(client, domain, dns_server))
+            pending[task] = dns_server
+            launched.append((task, time.perf_counter()))
+        return dns_server
+
+    hedge_delay = HEDGE_FACTOR * _RTT[hedge()]
+    exhausted = False
+    try:
+        while pending:
+            done, _ = await asyncio.wait(
+                pending, timeout=None if exhausted else hedge_delay,
+                return_when=asyncio.FIRST_COMPLETED
+            )
+            if not done:
+                exhausted = hedge() is None
+                continue
+            for task in done:
+                dns_server = pending.pop(task)
+                if task.exception() is not None:
+                    print(f"Debug: dnspython failed for {domain} with {dns_server}: {task.exception()}", file=sys.stderr)
+                    exhausted = hedge() is None
+                    continue
+                # Servers asked earlier but beaten by a hedge are at least
+                # as slow as they have waited so far; record that as an RTT
+                # sample, since cancelling them would otherwise leave their
+                # sRTT untouched (timeouts and errors are penalized instead)
+                now = time.perf_counter()
+                for earlier, started in launched:
+                    if earlier is task:
+                        break
+                    if earlier in pending:
+                        update_rtt(pending[earlier], now - started)
+                ips, ttl, canonical, canonical_ttl, cname_ttl = task.result()
+                cache_put(domain, ips, ttl)
+                if canonical != domain:
+                    cache_put(domain, {canonical}, cname_ttl, "CNAME")
+                    cache_put(canonical, ips, canonical_ttl)
+                return ips
+    finally:
+        for task in pending:
+            task.cancel()
+    return set()
+
+async def resolve_with_socket(domain):
+    """Resolve IPs using the system resolver as a fallback."""
     ips = set()
     try:
-        ip = socket.gethostbyname(domain)
-        ips.add(ip)
-        print(f"Debug: Socket resolved {domain} -> {ip}", file=sys.stderr)
+        addrinfo = await asyncio.get_running_loop().getaddrinfo(
+            domain, None, family=socket.AF_INET, type=socket.SOCK_STREAM
+        )
+        ips.update(sockaddr[0] for _, _, _, _, sockaddr in addrinfo)
+        print(f"Debug: Socket resolved {domain} -> {' '.join(sorted(ips))}", file=sys.stderr)
     except socket.gaierror as e:
         print(f"Debug: Socket failed for {domain}: {e}", file=sys.stderr)
     return ips
 
-def get_ips(sites):
-    """Resolve IPs dynamically with enhanced DNS."""
+async def lookup_domain(client, domain, fast=False):
+    """Resolve domain over DNS, then add what the system resolver returns."""
+    # Step 1: Resolve with dnspython, hedging across the fastest DNS servers
+    try:
+        ips = await resolve_domain(client, domain)
+    except Exception as e:
+        print(f"Debug: DNS lookup failed for {domain}: {e}", file=sys.stderr)
+        ips = set()
+    # Step 2: Fallback with socket; the local resolver returns the
+    # geo-local CDN edge the browser actually connects to (or a LAN /
+    # /etc/hosts address public DNS calls NXDOMAIN), so it is only
+    # skipped on request (--fast) once DNS gave enough coverage
+    if not (fast and len(ips) >= ENOUGH_IPS):
+        ips |= await resolve_with_socket(domain)
+    return ips
+
+async def _gather_all(domains, fast=False):
+    """Run every domain lookup concurrently on one event loop."""
+    transport, client = await asyncio.get_running_loop().create_datagram_endpoint(
+        DNSClient, local_addr=("0.0.0.0", 0)
+    )
+
     all_ips = set()
-    domains_to_check = set()
+    task_to_domain = {
+        asyncio.create_task(lookup_domain(client, domain, fast)): domain
+        for domain in domains
+    }
+    pending = set(task_to_domain)
+    try:
+        # Consume each lookup as soon as it finishes
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                try:
+                    all_ips.update(task.result())
+                except Exception as e:
+                    domain = task_to_domain[task]
+                    print(f"Debug: Lookup failed for {domain}: {e}", file=sys.stderr)
+    finally:
+        transport.close()
+    return all_ips
 
+def get_ips(sites, fast=False):
+    """Resolve IPs dynamically with enhanced DNS."""
     # Generic subdomain prefixes
     common_prefixes = [
         "", "www", "api", "m", "svc", "media", "cdn", "static", "gateway"
     ]
-    for site in sites:
-        for prefix in common_prefixes:
-            subdomain = f"{prefix}.{site}" if prefix else site
-            domains_to_check.add(subdomain)
-
-    # Step 1: Resolve with dnspython across multiple DNS servers
-    with ThreadPoolExecutor(max_workers=20) as executor:
-        future_to_domain = {
-            executor.submit(resolve_with_dnspython, domain, dns_server): (domain, dns_server)
-            for domain in domains_to_check
-            for dns_server in PUBLIC_DNS
-        }
-        for future in future_to_domain:
-            try:
-                ips = future.result()
-                all_ips.update(ips)
-            except Exception as e:
-                domain, dns_server = future_to_domain[future]
-                print(f"Debug: DNS future failed for {domain} with {dns_server}: {e}", file=sys.stderr)
-
-    # Step 2: Fallback with socket for additional coverage
-    with ThreadPoolExecutor(max_workers=5) as executor:
-        future_to_socket = {
-            executor.submit(resolve_with_socket, domain): domain
-            for domain in domains_to_check
-        }
-        for future in future_to_socket:
-            try:
-                ips = future.result()
-                all_ips.update(ips)
-            except Exception as e:
-                domain = future_to_socket[future]
-                print(f"Debug: Socket future failed for {domain}: {e}", file=sys.stderr)
+    domains_to_check = {
+        f"{prefix}.{site}" if prefix else site
+        for prefix, site in itertools.product(common_prefixes, sites)
+    }
+
+    all_ips = asyncio.run(_gather_all(domains_to_check, fast))
+    save_cache()
+    save_rtt()
 
     if not all_ips:
         print("Error: No IPs resolved.", file=sys.stderr)
@@ -99,11 +448,13 @@ def main():
     """Handle command-line arguments."""
     parser = argparse.ArgumentParser(description="Web Blocker IP Resolver (Lightweight DNS-Based)")
     parser.add_argument("--get-ips", nargs="+", help="Resolve IPs for domains.")
+    parser.add_argument("--fast", action="store_true",
+                        help="Skip the system resolver for domains DNS already resolved to enough IPs.")
     args = parser.parse_args()
 
     if args.get_ips:
-        ips = get_ips(args.get_ips)
-        print(" ".join(sorted(ips)))
+        ips = get_ips(args.get_ips, args.fast)
+        print(" ".join(sorted(ips, key=socket.inet_aton)))
     else:
         parser.print_help()
         sys.exit(1)